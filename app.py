@@ -1,7 +1,15 @@
 import streamlit as st
 import pandas as pd 
+import io
+import datetime # 処理結果のキャッシュを日付ごとに分けるために使用
 from kowake import create_repacking_priority_list_from_excel 
-# import datetime # サブタイトル削除のため不要に
+
+# --- 処理結果のキャッシュ ---
+# ダウンロードボタンのクリックなどによる再実行で、同じファイルの処理をやり直さないようにする
+# キャッシュのキーはアップロードファイルのバイト列・ファイル名・処理日 (出力ファイル名とタイトルに翌日の日付が入るため)
+@st.cache_data(show_spinner=False)
+def process_uploaded_file(file_bytes, file_name, processing_date):
+    return create_repacking_priority_list_from_excel(io.BytesIO(file_bytes))
 
 # --- Streamlit アプリケーションのUI設定 ---
 st.set_page_config(page_title="小分け作業用", layout="wide") # page_titleも変更
@@ -24,7 +32,9 @@ if uploaded_file is not None:
     # 処理実行ボタン
     if st.button("処理実行"):
         with st.spinner("処理中です... しばらくお待ちください。"):
-            success, message, output_filename, excel_data = create_repacking_priority_list_from_excel(uploaded_file)
+            success, message, output_filename, excel_data = process_uploaded_file(
+                uploaded_file.getvalue(), uploaded_file.name, datetime.date.today()
+            )
 
         if success:
             if output_filename and excel_data:
@@ -1,6 +1,6 @@
 import pandas as pd
 import numpy as np # numpy を使用して数値計算や条件分岐を効率的に行います
-import io
+import tempfile # 出力Excelの書き出し先 (SpooledTemporaryFile) のために使用
 import os # ファイルパスの存在確認のために os モジュールをインポート
 # import tkinter as tk # Streamlitデプロイのため削除済み
 # from tkinter import filedialog, messagebox  # Streamlitデプロイのため削除済み
@@ -8,9 +8,26 @@ import datetime # 日付取得のために追加
 
 # openpyxl.utils.get_column_letter を使用するためにインポート (pandasが内部で使用するopenpyxlに依存)
 # 通常、pandasと共にインストールされていれば利用可能
+# 出力ファイルは openpyxl の write_only モードで直接書き出すため、Workbook と WriteOnlyCell も使用する
 try:
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
     from openpyxl.utils import get_column_letter
-    from openpyxl.styles import Border, Side, Font, Color, Alignment 
+    from openpyxl.styles import Border, Side, Font, Color, Alignment, NamedStyle
+    from openpyxl.styles.fonts import DEFAULT_FONT
+
+    # 出力Excelのスタイル定義 (モジュール読み込み時に一度だけ生成し、各処理で共有する)
+    # openpyxl のスタイルオブジェクトはセルに割り当てた後に変更しないため、共有しても問題ない
+    TITLE_FONT = Font(bold=True, size=14)
+    THIN_BORDER_SIDE = Side(border_style="thin", color="000000")
+    THIN_BORDER = Border(left=THIN_BORDER_SIDE,
+                         right=THIN_BORDER_SIDE,
+                         top=THIN_BORDER_SIDE,
+                         bottom=THIN_BORDER_SIDE)
+    BOLD_FONT = Font(bold=True)
+    RED_FONT_FOR_SHORTAGE = Font(bold=True, color="FF0000")
+    DATA_ROW_VERTICAL_ALIGNMENT = Alignment(vertical='center')
+    HEADER_ROW_CENTER_ALIGNMENT = Alignment(horizontal='center', vertical='center')
 except ImportError:
     # openpyxl がないか、utils が見つからない場合のフォールバックやエラー処理
     def get_column_letter(idx): # 簡単なフォールバック (限定的)
@@ -27,6 +44,20 @@ except ImportError:
     class Font: pass
     class Color: pass
     class Alignment: pass
+    class Workbook: pass
+    class WriteOnlyCell: pass
+    class NamedStyle: pass
+    DEFAULT_FONT = None
+    TITLE_FONT = THIN_BORDER_SIDE = THIN_BORDER = BOLD_FONT = RED_FONT_FOR_SHORTAGE = None
+    DATA_ROW_VERTICAL_ALIGNMENT = HEADER_ROW_CENTER_ALIGNMENT = None
+
+# 入力Excelの読み込みには、インストールされていれば高速な calamine エンジン (python-calamine) を使用する
+# 利用できない場合は openpyxl エンジン (pandas が read_only モードで読み込む) にフォールバックする
+try:
+    import python_calamine # noqa: F401
+    excel_read_engine = 'calamine'
+except ImportError:
+    excel_read_engine = 'openpyxl'
 
 
 def create_repacking_priority_list_from_excel(file_path_or_obj, sheet_name=0):
@@ -55,12 +86,6 @@ def create_repacking_priority_list_from_excel(file_path_or_obj, sheet_name=0):
     """
     available_cols = [] # エラーメッセージ用に利用可能な列名を保持
     try:
-        # pandas.read_excel はファイルパスまたはファイルライクオブジェクトを受け取れる
-        df = pd.read_excel(file_path_or_obj, header=1, sheet_name=sheet_name)
-        
-        df.columns = df.columns.str.strip()
-        available_cols = df.columns.tolist()
-
         # --- Excelファイル内の列名定義 (これらの名前がファイルの2行目ヘッダーに存在することを確認) ---
         product_code_col_excel = "商品コード"
         product_name_col_excel = "商品名"
@@ -78,6 +103,22 @@ def create_repacking_priority_list_from_excel(file_path_or_obj, sheet_name=0):
             "納品数(E列)": delivery_qty_col_excel,
             "小分け不足数(K列)": action_needed_col_excel
         }
+
+        # 必要な6列だけを読み込む (他の列のセルは DataFrame に変換しない)
+        # ヘッダー名の前後の空白は無視して照合し、エラーメッセージ用に読み込まれたヘッダー名を記録する
+        required_col_names = set(required_input_cols_map.values())
+
+        def is_required_col(col_name):
+            header_name = str(col_name).strip()
+            if header_name not in available_cols:
+                available_cols.append(header_name)
+            return header_name in required_col_names
+
+        # pandas.read_excel はファイルパスまたはファイルライクオブジェクトを受け取れる
+        df = pd.read_excel(file_path_or_obj, header=1, sheet_name=sheet_name,
+                           usecols=is_required_col, engine=excel_read_engine)
+        
+        df.columns = df.columns.str.strip()
         
         missing_excel_cols = []
         for display_name, actual_col_name in required_input_cols_map.items():
@@ -90,168 +131,194 @@ def create_repacking_priority_list_from_excel(file_path_or_obj, sheet_name=0):
                           f"読み込まれたExcelヘッダー: {available_cols}"), None, None
 
         # --- データフィルタリング ---
-        df_temp_filtered = df[df[product_name_col_excel].astype(str).str.contains('◇', na=False)].copy()
-        if df_temp_filtered.empty:
-            return True, "対象商品（商品名に「◇」を含む）が見つかりませんでした。", None, None
-        
-        df_temp_filtered = df_temp_filtered[~df_temp_filtered[product_name_col_excel].astype(str).str.endswith('東一', na=False)].copy()
-        if df_temp_filtered.empty:
-            return True, "対象商品（商品名に「◇」を含み、かつ末尾が「東一」でない）が見つかりませんでした。", None, None
+        # 3つの条件 (「◇」を含む・末尾が「東一」でない・「今日入荷（作成）」が0でない) を1つのマスクにまとめて一度に抽出
+        # 商品名は一度だけ文字列に変換し、「◇」の検索は正規表現を使わない単純な部分文字列検索で行う
+        names = df[product_name_col_excel].astype(str)
+        today_numeric = pd.to_numeric(df[today_received_col_excel], errors='coerce').fillna(0)
+        contains_diamond = names.str.contains('◇', regex=False, na=False)
+        ends_with_touichi = names.str.endswith('東一', na=False)
+        mask = contains_diamond & ~ends_with_touichi & (today_numeric != 0)
+
+        # 対象商品がなければ、抽出・数値変換・並び替え・Excel出力を行わずにここで終了する
+        if not mask.any():
+            return True, "対象商品（商品名に「◇」を含み、末尾が「東一」でなく、かつ「今日入荷（作成）」が0でない）は見つかりませんでした。", None, None
+
+        # 「今日入荷（作成）」列はフィルタリングのために数値変換済みのため、その結果を再利用する
+        df[today_received_col_excel] = today_numeric
+
+        # ブールマスクによる抽出結果は元の df とは独立した新しい DataFrame のため、.copy() は不要
+        df_filtered = df.loc[mask].reset_index(drop=True)
 
         # --- 数値列を数値型に変換 ---
         numeric_cols_to_convert = [
+            prev_day_stock_col_excel,
+            delivery_qty_col_excel,
+            action_needed_col_excel
+        ]
+        df_filtered[numeric_cols_to_convert] = df_filtered[numeric_cols_to_convert].apply(pd.to_numeric, errors='coerce').fillna(0)
+        # 数量は通常整数のため、整数値のみの列は小さい整数型にダウンキャストする
+        # (値が変わらない場合だけ変換されるため、小数を含む列は float64 のまま残る)
+        quantity_cols = [
             prev_day_stock_col_excel,
             today_received_col_excel, 
             delivery_qty_col_excel,
             action_needed_col_excel
         ]
-        for col in numeric_cols_to_convert:
-            if col in df_temp_filtered.columns: 
-                 df_temp_filtered.loc[:, col] = pd.to_numeric(df_temp_filtered[col], errors='coerce').fillna(0)
-
-        df_filtered = df_temp_filtered[df_temp_filtered[today_received_col_excel] != 0].copy()
-        if df_filtered.empty:
-            return True, "対象商品（商品名に「◇」を含み、末尾が「東一」でなく、かつ「今日入荷（作成）」が0でない）は見つかりませんでした。", None, None
+        df_filtered[quantity_cols] = df_filtered[quantity_cols].apply(pd.to_numeric, downcast='integer')
             
         # --- 新規列の計算 (df_filtered に対して行う) ---
-        df_filtered.loc[:, 'calculated_充足率'] = np.where(
-            df_filtered[delivery_qty_col_excel] != 0,
-            df_filtered[prev_day_stock_col_excel] / df_filtered[delivery_qty_col_excel],
-            0
-        )
+        # np.divide の where= で、分母が条件を満たす要素だけを割り算する (0除算や余分な中間配列を発生させない)
+        prev_values = df_filtered[prev_day_stock_col_excel].to_numpy()
+        delivery_values = df_filtered[delivery_qty_col_excel].to_numpy()
+        action_values = df_filtered[action_needed_col_excel].to_numpy()
+
+        # 充足率 = 昨日残 / 納品数 (納品数が0の場合は0)
+        # Excelに出力する値のため float64 で計算する (float32 だとセルの値が 0.3333333432674408 のようになる)
+        fill_ratio = np.zeros(len(df_filtered), dtype=np.float64)
+        np.divide(prev_values, delivery_values, out=fill_ratio, where=delivery_values != 0)
+        df_filtered['calculated_充足率'] = fill_ratio
         
-        df_filtered.loc[:, 'calculated_E_K_ratio'] = np.where(
-            df_filtered[action_needed_col_excel] > 0, 
-            df_filtered[delivery_qty_col_excel] / df_filtered[action_needed_col_excel],
-            -1 
-        )
+        # E/K比 = 納品数 / 不足数 (不足数が0以下の場合は-1)
+        # 並び替えのキーとしてのみ使用し出力しないため、float32 の配列に直接書き込む
+        e_k_ratio = np.full(len(df_filtered), -1.0, dtype=np.float32)
+        np.divide(delivery_values, action_values, out=e_k_ratio, where=action_values > 0)
+        df_filtered['calculated_E_K_ratio'] = e_k_ratio
 
         # --- 並び替え (df_filtered に対して行う) ---
-        df_sorted = df_filtered.sort_values(
-            by=['calculated_充足率', action_needed_col_excel, prev_day_stock_col_excel, 'calculated_E_K_ratio'],
-            ascending=[True, True, True, False] 
-        )
+        # 充足率(昇順) → 不足数(昇順) → 昨日残(昇順) → E/K比(降順) の順に優先
+        # 並び順は数値のキー配列だけから np.lexsort で求め、DataFrame 全体は最後に一度だけ並べ替える
+        # (np.lexsort は最後に渡したキーを第一優先とし、全て昇順のため、降順のE/K比は符号を反転して渡す)
+        sort_order = np.lexsort((-e_k_ratio, prev_values, action_values, fill_ratio))
+        df_sorted = df_filtered.iloc[sort_order]
 
         # --- 出力用DataFrame作成 ---
-        output_df = pd.DataFrame()
-        output_df['商品コード'] = df_sorted[product_code_col_excel]
-        output_df['商品名'] = df_sorted[product_name_col_excel]
-        output_df['昨日残'] = df_sorted[prev_day_stock_col_excel]
-        output_df['本日作成'] = df_sorted[today_received_col_excel] 
-        output_df['納品数'] = df_sorted[delivery_qty_col_excel]
-        output_df['不足数'] = df_sorted[action_needed_col_excel] 
-        output_df['充足率'] = df_sorted['calculated_充足率'] 
+        # 出力列の選択と列名の変更を一度に行う (列を1つずつ追加して DataFrame を作り直さない)
+        output_df = df_sorted[[
+            product_code_col_excel,
+            product_name_col_excel,
+            prev_day_stock_col_excel,
+            today_received_col_excel,
+            delivery_qty_col_excel,
+            action_needed_col_excel,
+            'calculated_充足率'
+        ]].rename(columns={
+            product_code_col_excel: '商品コード',
+            product_name_col_excel: '商品名',
+            prev_day_stock_col_excel: '昨日残',
+            today_received_col_excel: '本日作成',
+            delivery_qty_col_excel: '納品数',
+            action_needed_col_excel: '不足数',
+            'calculated_充足率': '充足率'
+        })
         
         # --- 出力ファイル名の生成 ---
         # 翌日の日付(mmdd)を取得
         tomorrow_date_mmdd_filename = (datetime.datetime.now() + datetime.timedelta(days=1)).strftime("%m%d")
         output_filename = f"{tomorrow_date_mmdd_filename}_小分け作業の判断指標.xlsx"
-        
-        excel_buffer = io.BytesIO()
-        with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-            output_df.to_excel(writer, index=False, sheet_name='作業優先リスト', startrow=1) 
-            
-            # --- Excelの書式設定 ---
-            workbook  = writer.book
-            worksheet = writer.sheets['作業優先リスト']
-
-            # --- タイトル行の追加と設定 ---
-            # 翌日の日付(mm月dd日)を取得
-            tomorrow_date_title = (datetime.datetime.now() + datetime.timedelta(days=1)).strftime("%m月%d日") 
-            title_text = f"{tomorrow_date_title} 小分け作成メモ"
-            worksheet['B1'] = title_text
-            title_font = Font(bold=True, size=14) 
-            worksheet['B1'].font = title_font
-            worksheet['B1'].alignment = Alignment(vertical='center') 
-
-            # スタイル定義
-            thin_border_side = Side(border_style="thin", color="000000")
-            thin_border = Border(left=thin_border_side, 
-                                 right=thin_border_side, 
-                                 top=thin_border_side, 
-                                 bottom=thin_border_side)
-            bold_font = Font(bold=True) 
-            red_font_for_shortage = Font(bold=True, color="FF0000")
-            data_row_vertical_alignment = Alignment(vertical='center') 
-            header_row_center_alignment = Alignment(horizontal='center', vertical='center') 
-
-            # 列幅の設定
-            column_widths = [9.0, 37.0, 7.5, 9.0, 7.5, 7.5, 7.5] 
-            for i, width in enumerate(column_widths):
-                column_letter = get_column_letter(i + 1) # 1-indexed
-                worksheet.column_dimensions[column_letter].width = width
-
-            # 「本日作成」列と「不足数」列の列文字を取得
-            try:
-                honjitsu_sakusei_col_index = output_df.columns.get_loc('本日作成') + 1
-                honjitsu_sakusei_col_letter = get_column_letter(honjitsu_sakusei_col_index)
-            except KeyError:
-                honjitsu_sakusei_col_letter = None
-                print("警告: '本日作成' 列が見つからず、書式設定をスキップします。")
-            
-            try:
-                shortage_col_index = output_df.columns.get_loc('不足数') + 1
-                shortage_col_letter = get_column_letter(shortage_col_index)
-            except KeyError:
-                shortage_col_letter = None 
-                print("警告: '不足数' 列が見つからず、書式設定をスキップします。")
-
-            # 全データセルに書式を適用 (タイトル行、ヘッダー行、データ行)
-            # 行の高さもここで設定
-            for row_idx in range(1, worksheet.max_row + 1): # 1から始まる行インデックス
-                worksheet.row_dimensions[row_idx].height = 18.0
-                for cell in worksheet[row_idx]: # 特定の行のセルをイテレート
-                    current_cell_col_letter = get_column_letter(cell.column)
-                    
-                    if cell.row == 1: # タイトル行 (1行目)
-                        if cell.column == 2: # B列のみ (タイトルセル)
-                             cell.alignment = Alignment(vertical='center') 
-                        # タイトル行の他のセルには罫線を適用しない
-                    elif cell.row == 2: # ヘッダー行 (2行目)
-                        cell.border = thin_border # ヘッダー行に罫線を適用
-                        cell.alignment = header_row_center_alignment
-                        if honjitsu_sakusei_col_letter and current_cell_col_letter == honjitsu_sakusei_col_letter:
-                            cell.font = bold_font 
-                    else: # データ行 (3行目以降)
-                        cell.border = thin_border # データ行に罫線を適用
-                        cell.alignment = data_row_vertical_alignment
-                        if honjitsu_sakusei_col_letter and current_cell_col_letter == honjitsu_sakusei_col_letter:
-                            cell.font = bold_font 
-                        elif shortage_col_letter and current_cell_col_letter == shortage_col_letter:
-                            cell.font = red_font_for_shortage 
-            
-            # 「充足率」列 (G列) にパーセント表示形式を適用 (データは3行目から)
-            try:
-                column_index_percent = output_df.columns.get_loc('充足率') + 1 
-                column_letter_percent = get_column_letter(column_index_percent)
-                
-                for row_num in range(3, worksheet.max_row + 1): # データ行は3行目から
-                    cell = worksheet[f'{column_letter_percent}{row_num}']
-                    cell.number_format = '0.0%' 
-            except KeyError:
-                print("警告: '充足率' 列が見つからず、パーセント書式を適用できませんでした。")
-            except Exception as e:
-                print(f"警告: パーセント書式の適用中にエラーが発生しました: {e}")
-
-            # --- フッターの追加 ---
-            if worksheet.max_row >= 2 : # ヘッダー行(2行目)が存在すれば、その下にデータがあるか、少なくともヘッダーはある
-                # 1行目のフッター (充足率の説明)
-                footer1_row_num = worksheet.max_row + 2 
-                worksheet.row_dimensions[footer1_row_num].height = 18.0
-                footer1_text = "※充足率＝「納品数」に対する「昨日残数」の割合（昨日残数÷納品数）"
-                footer1_cell = worksheet[f'A{footer1_row_num}'] 
-                footer1_cell.value = footer1_text
-                footer1_cell.alignment = data_row_vertical_alignment
-
-                # 2行目のフッター (東一商品の注釈)
-                footer2_row_num = footer1_row_num + 1 
-                worksheet.row_dimensions[footer2_row_num].height = 18.0
-                footer2_text = "※「東一」用の商品名の記載はありませんが、該当商品の不足数には反映されています。" 
-                footer2_cell = worksheet[f'A{footer2_row_num}'] 
-                footer2_cell.value = footer2_text
-                footer2_cell.alignment = data_row_vertical_alignment
-            
-        excel_data = excel_buffer.getvalue()
+
+        # --- Excelの書き出し (write_only モード) ---
+        # セルをメモリに保持せず、書式を付けた WriteOnlyCell を1行ずつ ws.append() で書き出す
+        # write_only モードでは列幅・行高をセルの追加前に設定しておく必要がある
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet('作業優先リスト')
+
+        # データ行の書式 (罫線・縦中央揃え・フォント) は名前付きスタイルとしてワークブックに一度だけ登録し、
+        # 各セルには cell.style の1回の割り当てで適用する
+        data_style = NamedStyle(name='data_style', font=DEFAULT_FONT,
+                                border=THIN_BORDER, alignment=DATA_ROW_VERTICAL_ALIGNMENT)
+        data_bold_style = NamedStyle(name='data_bold_style', font=BOLD_FONT,
+                                     border=THIN_BORDER, alignment=DATA_ROW_VERTICAL_ALIGNMENT)
+        data_shortage_style = NamedStyle(name='data_shortage_style', font=RED_FONT_FOR_SHORTAGE,
+                                         border=THIN_BORDER, alignment=DATA_ROW_VERTICAL_ALIGNMENT)
+        # 「充足率」列はパーセント表示形式 (小数点以下1桁) もスタイルに含める
+        data_percent_style = NamedStyle(name='data_percent_style', font=DEFAULT_FONT, number_format='0.0%',
+                                        border=THIN_BORDER, alignment=DATA_ROW_VERTICAL_ALIGNMENT)
+        for named_style in (data_style, data_bold_style, data_shortage_style, data_percent_style):
+            workbook.add_named_style(named_style)
+
+        # 出力列の列文字は一度だけ求めておく (セルごとに get_column_letter を呼ばない)
+        # 出力列は上で固定の列名で作成しているため、列名 → 列文字 の対応表から直接引ける (列の存在確認は不要)
+        col_letter_by_name = {column_name: get_column_letter(i + 1) # 1-indexed
+                              for i, column_name in enumerate(output_df.columns)}
+
+        # 列幅の設定
+        column_widths = [9.0, 37.0, 7.5, 9.0, 7.5, 7.5, 7.5] 
+        for column_letter, width in zip(col_letter_by_name.values(), column_widths):
+            worksheet.column_dimensions[column_letter].width = width
+
+        # 行高の設定 (全ての行を18.0とする)
+        # 行ごとに row_dimensions を設定せず、シートの既定の行高として一度だけ設定する
+        worksheet.sheet_format.defaultRowHeight = 18.0
+        worksheet.sheet_format.customHeight = True
+
+        # 「本日作成」列・「不足数」列・「充足率」列 (G列) の列文字を取得
+        honjitsu_sakusei_col_letter = col_letter_by_name['本日作成']
+        shortage_col_letter = col_letter_by_name['不足数']
+        column_letter_percent = col_letter_by_name['充足率']
+
+        # --- タイトル行の追加と設定 (1行目) ---
+        # 翌日の日付(mm月dd日)を取得
+        tomorrow_date_title = (datetime.datetime.now() + datetime.timedelta(days=1)).strftime("%m月%d日") 
+        title_text = f"{tomorrow_date_title} 小分け作成メモ"
+        title_cell = WriteOnlyCell(worksheet, value=title_text)
+        title_cell.font = TITLE_FONT
+        title_cell.alignment = Alignment(vertical='center') 
+        worksheet.append([None, title_cell]) # B列のみ (タイトルセル)、罫線は適用しない
+
+        # --- ヘッダー行の追加と設定 (2行目) ---
+        header_row = []
+        for column_name, column_letter in col_letter_by_name.items():
+            cell = WriteOnlyCell(worksheet, value=column_name)
+            cell.border = THIN_BORDER # ヘッダー行に罫線を適用
+            cell.alignment = HEADER_ROW_CENTER_ALIGNMENT
+            if column_letter == honjitsu_sakusei_col_letter:
+                cell.font = BOLD_FONT 
+            header_row.append(cell)
+        worksheet.append(header_row)
+
+        # --- データ行の追加と設定 (3行目以降) ---
+        # データ行に罫線・縦中央揃えを適用 (「本日作成」列は太字、「不足数」列は太字・赤字、「充足率」列はパーセント表示)
+        # 各列に適用するスタイル名は行ループの前に一度だけ決めておく
+        data_col_styles = []
+        for column_letter in col_letter_by_name.values():
+            if column_letter == honjitsu_sakusei_col_letter:
+                data_col_styles.append('data_bold_style')
+            elif column_letter == shortage_col_letter:
+                data_col_styles.append('data_shortage_style')
+            elif column_letter == column_letter_percent:
+                data_col_styles.append('data_percent_style')
+            else:
+                data_col_styles.append('data_style')
+
+        for row_values in output_df.itertuples(index=False, name=None):
+            data_row = []
+            for cell_style, value in zip(data_col_styles, row_values):
+                cell = WriteOnlyCell(worksheet, value=value)
+                cell.style = cell_style
+                data_row.append(cell)
+            worksheet.append(data_row)
+
+        # --- フッターの追加 (最終データ行の1行下を空けて記述) ---
+        worksheet.append([])
+
+        # 1行目のフッター (充足率の説明)
+        footer1_text = "※充足率＝「納品数」に対する「昨日残数」の割合（昨日残数÷納品数）"
+        footer1_cell = WriteOnlyCell(worksheet, value=footer1_text)
+        footer1_cell.alignment = DATA_ROW_VERTICAL_ALIGNMENT
+        worksheet.append([footer1_cell])
+
+        # 2行目のフッター (東一商品の注釈)
+        footer2_text = "※「東一」用の商品名の記載はありませんが、該当商品の不足数には反映されています。" 
+        footer2_cell = WriteOnlyCell(worksheet, value=footer2_text)
+        footer2_cell.alignment = DATA_ROW_VERTICAL_ALIGNMENT
+        worksheet.append([footer2_cell])
+
+        # ZIP の書き出し先は SpooledTemporaryFile とし、16MB まではメモリ上、それを超えたら一時ファイルに書き出す
+        # (大きな出力でメモリ上のバッファが拡張を繰り返さないようにする)
+        with tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024) as excel_buffer:
+            workbook.save(excel_buffer)
+            excel_buffer.seek(0)
+            excel_data = excel_buffer.read()
 
         return True, f"処理が完了しました。「{output_filename}」を確認してください。", output_filename, excel_data
 